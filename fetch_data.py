@@ -1,15 +1,19 @@
 # fetch_data.py
+import asyncio
 import os
-import json
-import time
 from dataclasses import asdict, dataclass
 from datetime import datetime, date
-from io import StringIO
+from io import BytesIO
 from typing import Dict, List, Tuple
 
+import httpx
+import numpy as np
+import orjson
 import pandas as pd
+import pyarrow as pa
 import pytz
-import requests
+from pyarrow import csv as pacsv
+from pyarrow import parquet as pq
 
 
 SP500_CONSTITUENTS_URL = (
@@ -26,17 +30,42 @@ UA = (
     "Chrome/120.0.0.0 Safari/537.36"
 )
 
+DEFAULT_HEADERS = {
+    "User-Agent": UA,
+    "Accept": "text/csv,text/plain;q=0.9,*/*;q=0.1",
+    "Accept-Language": "en-US,en;q=0.9",
+    "Referer": "https://stooq.com/",
+    "Cache-Control": "no-cache",
+    "Pragma": "no-cache",
+}
+
 REQ_TIMEOUT = 20
 PER_TICKER_RETRIES = 3
 SLEEP_BASE = 0.25
 
-PAUSE_EVERY = 1
-PAUSE_SECS = 0.25
+MAX_CONCURRENCY = 20
+RATE_LIMIT_PER_SEC = 4.0
+RATE_LIMIT_BURST = 8.0
+RATE_LIMIT_MIN_PER_SEC = 0.5
+RATE_LIMIT_DECREASE = 0.8
+RATE_LIMIT_INCREASE = 0.1
+
+CSV_CONVERT_OPTIONS = pacsv.ConvertOptions(
+    include_columns=["Date", "Close"],
+    column_types={"Date": pa.date32(), "Close": pa.float32()},
+)
+
+PARQUET_COMPRESSION = "zstd"
+PARQUET_COMPRESSION_LEVEL = 3
+PARQUET_ROW_GROUP_SIZE = 4096
 
 OUT_PARQUET = "sp500_etf.parquet"
 OUT_FAILURES = "sp500_etf_failures.csv"
 OUT_META = "sp500_etf_meta.json"
 
+CONSTITUENTS_CACHE = "sp500_constituents.csv"
+CONSTITUENTS_ETAG = "sp500_constituents.etag"
+
 
 def normalize_symbol_for_yahoo(s: str) -> str:
     return str(s).strip().replace(".", "-")
@@ -50,8 +79,27 @@ def _yyyymmdd(x: str) -> str:
     return pd.Timestamp(x).strftime("%Y%m%d")
 
 
-def get_sp500_tickers() -> List[str]:
-    df = pd.read_csv(SP500_CONSTITUENTS_URL, usecols=["Symbol"])
+def get_sp500_tickers(client: httpx.Client) -> List[str]:
+    headers = {}
+    if os.path.exists(CONSTITUENTS_CACHE) and os.path.exists(CONSTITUENTS_ETAG):
+        with open(CONSTITUENTS_ETAG, encoding="utf-8") as f:
+            headers["If-None-Match"] = f.read().strip()
+
+    r = client.get(SP500_CONSTITUENTS_URL, headers=headers)
+    if r.status_code == 304:
+        with open(CONSTITUENTS_CACHE, "rb") as f:
+            body = f.read()
+    else:
+        r.raise_for_status()
+        body = r.content
+        with open(CONSTITUENTS_CACHE, "wb") as f:
+            f.write(body)
+        etag = r.headers.get("etag")
+        if etag:
+            with open(CONSTITUENTS_ETAG, "w", encoding="utf-8") as f:
+                f.write(etag)
+
+    df = pd.read_csv(BytesIO(body), usecols=["Symbol"])
     return (
         df["Symbol"]
         .astype(str)
@@ -70,106 +118,332 @@ def get_additional_etfs() -> List[str]:
     ]
 
 
-def _build_stooq_url(symbol: str, start: str, end: str) -> str:
-    url = STOOQ_URL_TMPL.format(symbol=symbol, d1=_yyyymmdd(start), d2=_yyyymmdd(end))
+def _build_stooq_url(symbol: str, d1: str, d2: str) -> str:
+    url = STOOQ_URL_TMPL.format(symbol=symbol, d1=d1, d2=d2)
     if STOOQ_APIKEY:
         url = f"{url}&apikey={STOOQ_APIKEY}"
     return url
 
 
-def _get_text(session: requests.Session, url: str):
-    headers = {
-        "User-Agent": UA,
-        "Accept": "text/csv,text/plain;q=0.9,*/*;q=0.1",
-        "Accept-Language": "en-US,en;q=0.9",
-        "Referer": "https://stooq.com/",
-        "Cache-Control": "no-cache",
-        "Pragma": "no-cache",
-    }
-    r = session.get(url, timeout=REQ_TIMEOUT, headers=headers)
-    return r.status_code, r.headers.get("content-type", ""), r.text
+class PermanentTickerError(RuntimeError):
+    """Failure that a retry cannot fix (unknown ticker, bad schema)."""
+
+
+class NoDataError(PermanentTickerError):
+    """Stooq returned no rows for the requested window.
+
+    Fatal for a full-history fetch, but expected on incremental runs
+    whenever no session has closed since the stored data (holidays, runs
+    before the day's close is published).
+    """
+
+
+class TransientHttpError(RuntimeError):
+    """Throttle page or transport hiccup that is worth retrying."""
 
 
-def download_stooq_close_one(
-    session: requests.Session, ticker: str, start: str, end: str
-) -> pd.Series:
-    sym = to_stooq_symbol(ticker)
-    url = _build_stooq_url(sym, start, end)
+class _RateLimiter:
+    """Token-bucket limiter shared by all download tasks.
+
+    Tokens refill at ``rate`` per second up to ``capacity``; ``acquire``
+    waits until a token is available, so the aggregate request rate stays
+    under Stooq's limits without a fixed per-request sleep.
+
+    The rate adapts TCP-style: ``penalize`` (throttle signal from Stooq)
+    cuts it multiplicatively, ``reward`` (clean response) restores it
+    additively up to the configured ceiling. All tasks run on one event
+    loop, so the bookkeeping needs no lock.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self._rate = rate
+        self._max_rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._last = 0.0
+
+    async def acquire(self) -> None:
+        loop = asyncio.get_running_loop()
+        if not self._last:
+            self._last = loop.time()
+        while True:
+            now = loop.time()
+            self._tokens = min(
+                self._capacity, self._tokens + (now - self._last) * self._rate
+            )
+            self._last = now
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return
+            await asyncio.sleep((1.0 - self._tokens) / self._rate)
+
+    def penalize(self) -> None:
+        self._rate = max(RATE_LIMIT_MIN_PER_SEC, self._rate * RATE_LIMIT_DECREASE)
+
+    def reward(self) -> None:
+        self._rate = min(self._max_rate, self._rate + RATE_LIMIT_INCREASE)
+
+
+def _make_client() -> httpx.Client:
+    """Synchronous client for one-off fetches (constituents list)."""
+    return httpx.Client(
+        headers=DEFAULT_HEADERS,
+        timeout=REQ_TIMEOUT,
+        follow_redirects=True,
+        default_encoding="utf-8",
+    )
+
+
+def _make_async_client() -> httpx.AsyncClient:
+    """HTTP/2 client for the bulk ticker downloads.
+
+    Multiplexing many in-flight requests over a handful of keep-alive
+    connections needs far fewer TLS handshakes than one connection per
+    worker thread did.
+    """
+    return httpx.AsyncClient(
+        http2=True,
+        headers=DEFAULT_HEADERS,
+        timeout=REQ_TIMEOUT,
+        follow_redirects=True,
+        default_encoding="utf-8",
+        limits=httpx.Limits(
+            max_connections=MAX_CONCURRENCY,
+            max_keepalive_connections=MAX_CONCURRENCY,
+        ),
+    )
+
 
+async def download_stooq_close_one(
+    client: httpx.AsyncClient, ticker: str, url: str,
+    limiter: _RateLimiter,
+) -> Tuple[np.ndarray, np.ndarray]:
     last_err = None
     for attempt in range(1, PER_TICKER_RETRIES + 1):
         try:
-            status, ct, txt = _get_text(session, url)
-            head = (txt[:400] or "").strip().lower()
-
-            if "get your apikey" in head or "captcha" in head or "&get_apikey" in head:
-                raise RuntimeError("stooq requires apikey/captcha for csv download")
+            return await _fetch_close_arrays(client, url, limiter)
+        except (TransientHttpError, httpx.TransportError) as e:
+            # Permanent failures (PermanentTickerError) propagate straight
+            # to the driver; only throttles and transport hiccups retry.
+            last_err = e
+            await asyncio.sleep(min(5.0, SLEEP_BASE * (2 ** attempt)))
+
+    raise TransientHttpError(f"{ticker}: {last_err}")
+
+
+async def _fetch_close_arrays(
+    client: httpx.AsyncClient, url: str, limiter: _RateLimiter
+) -> Tuple[np.ndarray, np.ndarray]:
+    await limiter.acquire()
+
+    # Sniff the first bytes and bail before pulling down the rest of the
+    # body (often a multi-KB HTML error page) for garbage responses.
+    async with client.stream("GET", url) as r:
+        status = r.status_code
+        ct = r.headers.get("content-type", "")
+
+        if status in (429, 500, 502, 503, 504):
+            if status == 429:
+                limiter.penalize()
+            raise TransientHttpError(f"http status={status} ct={ct}")
+
+        chunks = r.aiter_bytes()
+        buf = bytearray()
+        async for chunk in chunks:
+            buf += chunk
+            if len(buf) >= 400:
+                break
+        head = bytes(buf[:400]).strip().lower()
+
+        if b"get your apikey" in head or b"captcha" in head or b"&get_apikey" in head:
+            raise PermanentTickerError("stooq requires apikey/captcha for csv download")
+
+        if head.startswith(b"no data"):
+            raise NoDataError("no data")
+
+        # Stooq serves CSV as text/csv or application/octet-stream and
+        # error/throttle pages as text/html — but so is the captcha wall,
+        # which must keep its permanent classification above, so the
+        # content-type only feeds the transient check after the sniff.
+        is_htmlish = (
+            "html" in ct.lower()
+            or head.startswith(b"<!doctype")
+            or head.startswith(b"<html")
+            or b"too many requests" in head
+        )
+        is_not_csv = b"date,open,high,low,close" not in head
 
-            if head.startswith("no data"):
-                raise RuntimeError("no data")
+        if b"too many requests" in head:
+            limiter.penalize()
 
-            is_htmlish = (
-                head.startswith("<!doctype")
-                or head.startswith("<html")
-                or "too many requests" in head
+        if is_htmlish or is_not_csv:
+            raise TransientHttpError(
+                f"non-csv response status={status} ct={ct} head={head[:160]!r}"
             )
-            is_not_csv = "date,open,high,low,close" not in head
 
-            if status in (429, 500, 502, 503, 504) or is_htmlish or is_not_csv:
-                raise RuntimeError(
-                    f"non-csv response status={status} ct={ct} head={head[:160]!r}"
-                )
+        async for chunk in chunks:
+            buf += chunk
+        body = bytes(buf)
+
+    tbl = pacsv.read_csv(
+        pa.py_buffer(body),
+        convert_options=CSV_CONVERT_OPTIONS,
+    )
+    if tbl.num_rows == 0:
+        raise NoDataError(f"no rows (columns={tbl.column_names})")
 
-            df = pd.read_csv(StringIO(txt))
-            if df.empty or "Date" not in df.columns or "Close" not in df.columns:
-                raise RuntimeError(f"bad csv columns={list(df.columns)}")
+    dates = tbl.column("Date").to_numpy(zero_copy_only=False).astype("datetime64[D]")
+    closes = tbl.column("Close").to_numpy(zero_copy_only=False).astype(
+        np.float32, copy=False
+    )
 
-            df["Date"] = pd.to_datetime(df["Date"], errors="coerce")
-            df = df.dropna(subset=["Date"]).set_index("Date").sort_index()
+    valid = ~np.isnan(closes)
+    if not valid.all():
+        dates, closes = dates[valid], closes[valid]
+    if closes.size == 0:
+        raise NoDataError("no close data")
 
-            s = df["Close"].dropna()
-            s.name = ticker
-            if s.empty:
-                raise RuntimeError("no close data")
+    # Stooq serves rows in ascending date order; only pay for a sort on
+    # the rare violation.
+    if dates.size > 1 and not (dates[1:] >= dates[:-1]).all():
+        order = np.argsort(dates, kind="stable")
+        dates, closes = dates[order], closes[order]
 
-            return s
+    limiter.reward()
+    return dates, closes
 
-        except Exception as e:
-            last_err = e
-            time.sleep(min(5.0, SLEEP_BASE * (2 ** attempt)))
 
-    raise RuntimeError(f"{ticker}: {last_err}")
+def _load_previous_prices() -> pd.DataFrame | None:
+    if not os.path.exists(OUT_PARQUET):
+        return None
+    try:
+        return pd.read_parquet(OUT_PARQUET)
+    except Exception as e:
+        print(f"[stooq] ignoring unreadable {OUT_PARQUET}: {e}")
+        return None
 
 
 def download_stooq_prices(
-    tickers: List[str], start: str, end: str
+    tickers: List[str], start: str, end: str, prev: pd.DataFrame | None = None
 ) -> Tuple[pd.DataFrame, Dict[str, str]]:
-    prices = []
-    failures: Dict[str, str] = {}
+    return asyncio.run(_download_stooq_prices_async(tickers, start, end, prev))
 
-    with requests.Session() as session:
-        for i, t in enumerate(tickers, 1):
-            try:
-                prices.append(download_stooq_close_one(session, t, start=start, end=end))
-            except Exception as e:
-                failures[t] = str(e)
 
-            if i % 25 == 0:
-                print(f"[stooq] done {i}/{len(tickers)}")
-                time.sleep(2.0)
-
-            if PAUSE_EVERY and (i % PAUSE_EVERY == 0):
-                time.sleep(PAUSE_SECS)
+async def _download_stooq_prices_async(
+    tickers: List[str], start: str, end: str, prev: pd.DataFrame | None = None
+) -> Tuple[pd.DataFrame, Dict[str, str]]:
+    failures: Dict[str, str] = {}
+    limiter = _RateLimiter(rate=RATE_LIMIT_PER_SEC, capacity=RATE_LIMIT_BURST)
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+    done = 0
+
+    # One contiguous (T, N) float32 buffer on a shared business-day index:
+    # each finished ticker scatters into its column, so there is no N-way
+    # index alignment at the end.
+    idx = pd.bdate_range(start, end)
+    bdays = idx.values.astype("datetime64[D]")
+    arr = np.full((len(idx), len(tickers)), np.nan, dtype=np.float32)
+    col = {t: i for i, t in enumerate(tickers)}
+    ok: set = set()
+
+    # Incremental runs: tickers with history on disk only need data past
+    # their last stored close, which cuts each CSV from years to days.
+    last_seen: Dict[str, pd.Timestamp] = {}
+    if prev is not None and not prev.empty:
+        for t in tickers:
+            if t in prev.columns:
+                lv = prev[t].last_valid_index()
+                if lv is not None:
+                    last_seen[t] = pd.Timestamp(lv)
+
+    d1_full, d2 = _yyyymmdd(start), _yyyymmdd(end)
+    urls: Dict[str, str] = {}
+    for t in tickers:
+        lv = last_seen.get(t)
+        if lv is not None and lv >= idx[-1]:
+            continue  # already current, nothing to fetch
+        d1 = (lv + pd.Timedelta(days=1)).strftime("%Y%m%d") if lv is not None else d1_full
+        urls[t] = _build_stooq_url(to_stooq_symbol(t), d1, d2)
+
+    fetch_tickers = list(urls)
+
+    async def fetch_one(client: httpx.AsyncClient, t: str):
+        nonlocal done
+        try:
+            async with sem:
+                return await download_stooq_close_one(client, t, urls[t], limiter)
+        finally:
+            done += 1
+            if done % 25 == 0:
+                print(f"[stooq] done {done}/{len(fetch_tickers)}")
+
+    if fetch_tickers:
+        async with _make_async_client() as client:
+            results = await asyncio.gather(
+                *(fetch_one(client, t) for t in fetch_tickers),
+                return_exceptions=True,
+            )
 
-    df = pd.concat(prices, axis=1) if prices else pd.DataFrame()
-    if not df.empty:
+        for t, res in zip(fetch_tickers, results):
+            if isinstance(res, NoDataError) and t in last_seen:
+                # Incremental window past the last stored close: no new
+                # rows simply means the ticker is already current.
+                ok.add(t)
+                continue
+            if isinstance(res, Exception):
+                failures[t] = str(res)
+                continue
+            dates, closes = res
+            # Scatter straight into the ticker's column; dates that fall
+            # outside the business-day index are dropped.
+            pos = np.minimum(np.searchsorted(bdays, dates), len(bdays) - 1)
+            hit = bdays[pos] == dates
+            arr[pos[hit], col[t]] = closes[hit]
+            ok.add(t)
+
+    ok_tickers = [t for t in tickers if t in ok]
+    if ok_tickers:
+        df = pd.DataFrame(
+            arr[:, [col[t] for t in ok_tickers]], index=idx, columns=ok_tickers
+        )
+        df.index.name = "date"
+        df = df.dropna(how="all")
+    else:
+        df = pd.DataFrame()
+
+    if prev is not None and not prev.empty:
+        # Fresh closes win on overlap; stored history fills the rest, so a
+        # transient failure this run never erases a ticker's past data.
+        df = df.combine_first(prev) if not df.empty else prev
+        ordered = [t for t in tickers if t in df.columns]
+        ordered += [c for c in df.columns if c not in set(tickers)]
+        df = df[ordered]
         df.index.name = "date"
-        df = df.sort_index()
-        df = df.loc[:, ~df.columns.duplicated()]
 
     return df, failures
 
 
+def _write_prices_parquet(data: pd.DataFrame, path: str) -> None:
+    """Write the price matrix straight through Arrow.
+
+    ``Table.from_pandas`` copies each column out of the frame's single
+    C-order block while converting NaN to nulls, keeping the pandas index
+    metadata so ``read_parquet`` restores the date index;
+    ``ParquetWriter`` then streams bounded row groups instead of
+    buffering the whole file through ``to_parquet``.
+    """
+    tbl = pa.Table.from_pandas(data, preserve_index=True)
+    with pq.ParquetWriter(
+        path,
+        tbl.schema,
+        compression=PARQUET_COMPRESSION,
+        compression_level=PARQUET_COMPRESSION_LEVEL,
+        use_dictionary=False,
+        write_statistics=True,
+    ) as writer:
+        writer.write_table(tbl, row_group_size=PARQUET_ROW_GROUP_SIZE)
+
+
 @dataclass
 class Meta:
     generated_at_et: str
@@ -190,11 +464,13 @@ def fetch_and_save_data() -> Tuple[pd.DataFrame, Dict[str, str]]:
     start = start_dt.isoformat()
     end = end_dt.isoformat()
 
-    tickers = get_sp500_tickers() + get_additional_etfs()
+    with _make_client() as client:
+        tickers = get_sp500_tickers(client) + get_additional_etfs()
     tickers = list(dict.fromkeys(tickers))
 
-    print(f"Tickers: {len(tickers)} | start={start} end={end}")
-    data, failures = download_stooq_prices(tickers, start=start, end=end)
+    prev = _load_previous_prices()
+    print(f"Tickers: {len(tickers)} | start={start} end={end} | incremental={prev is not None}")
+    data, failures = download_stooq_prices(tickers, start=start, end=end, prev=prev)
 
     if failures:
         pd.Series(failures, name="error").to_csv(OUT_FAILURES, header=True)
@@ -208,7 +484,12 @@ def fetch_and_save_data() -> Tuple[pd.DataFrame, Dict[str, str]]:
         )
 
     max_date = pd.to_datetime(data.index.max()).date().isoformat()
-    data.to_parquet(OUT_PARQUET, engine="pyarrow")
+
+    # Closes are float32 all the way through; the cast is a no-op guard
+    # (copy=False) that keeps the on-disk format half the size of float64
+    # should an upstream step ever widen the dtype.
+    data = data.astype(np.float32, copy=False)
+    _write_prices_parquet(data, OUT_PARQUET)
 
     meta = Meta(
         generated_at_et=datetime.now(tz).isoformat(),
@@ -220,8 +501,8 @@ def fetch_and_save_data() -> Tuple[pd.DataFrame, Dict[str, str]]:
         failures=len(failures),
         max_date=max_date,
     )
-    with open(OUT_META, "w", encoding="utf-8") as f:
-        json.dump(asdict(meta), f, indent=2)
+    with open(OUT_META, "wb") as f:
+        f.write(orjson.dumps(asdict(meta), option=orjson.OPT_INDENT_2))
 
     print(f"Saved: {OUT_PARQUET} | cols={data.shape[1]} | max_date={max_date} | failures={len(failures)}")
     return data, failures